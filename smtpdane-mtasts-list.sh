@@ -1,4 +1,5 @@
 #!/bin/bash
 smtpdane-mtasts-lookup.py -H
-sort -u "$@" | xargs --max-args 100 --max-procs 100 smtpdane-mtasts-lookup.py --delimiter '|' --flush | sort
+# each lookup process resolves its domains concurrently, so one process per CPU is enough
+sort -u "$@" | xargs --max-args 1000 --max-procs "$(nproc)" smtpdane-mtasts-lookup.py --delimiter '|' --flush | sort
 #sort -u "$@" | xargs smtpdane-mtasts-lookup.py --delimiter '|' --flush #| sort
\ No newline at end of file
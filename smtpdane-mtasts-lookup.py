@@ -17,53 +17,238 @@ Output:
   Published records are not validated.
 '''
 import argparse
+import asyncio
+import copy
+import csv
 import functools
-from typing import List, Tuple
+import sqlite3
+import sys
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+import dns.asyncquery
+import dns.asyncresolver
+import dns.inet
+import dns.message
+import dns.name
+import dns.nameserver
+import dns.rdataclass
+import dns.rdatatype
 import dns.resolver
 
-def validmx(mx: str) -> bool:
+def cachedtask(f: Callable[..., Awaitable]) -> Callable[..., asyncio.Task]:
     '''
-    Return False for MX records that do not represent a SMTP server:
-    - .:  Null MX as defined in RFC 7505 meaning that the domain doesn't accept any email.
-    - 0.0.0.0., localhost. and ~.: Sometimes used in indicate the same as .
+    Memoize coroutine function f by its arguments.
+    The task is cached rather than the coroutine, so concurrent callers await the same lookup.
     '''
-    match mx:
-        case '.' | '0.0.0.0.' | 'localhost.' | '~.':
-            return False
-        case _:
-            return True
+    @functools.cache
+    def wrapper(*args):
+        return asyncio.ensure_future(f(*args))
+    return wrapper
 
-def lookupmx(resolver: dns.resolver.Resolver, domain: str) -> Tuple[List[str], bool, str]:
+class RacingResolver:
+    '''
+    Resolve by querying up to `parallel` nameservers of `resolver` concurrently, musl style.
+    The first answer wins, including NXDOMAIN and NoAnswer, and the remaining queries are cancelled.
+    Each racing query starts at a different nameserver and falls back to the others in turn,
+    so nameservers beyond `parallel` are still asked when the first ones fail (SERVFAIL, timeout).
+    '''
+    def __init__(self, resolver: dns.asyncresolver.Resolver, parallel: int):
+        self.resolvers = []
+        nameservers = resolver.nameservers
+        for i in range(min(parallel, len(nameservers))):
+            r = copy.copy(resolver)
+            r.nameservers = nameservers[i:] + nameservers[:i]
+            self.resolvers.append(r)
+
+    async def resolve(self, qname: dns.name.Name | str, rdtype: str) -> dns.resolver.Answer:
+        pending = { asyncio.ensure_future(r.resolve(qname, rdtype)) for r in self.resolvers }
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        return task.result()
+                    except (dns.resolver.NoNameservers, dns.resolver.LifetimeTimeout) as e:
+                        error = e
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+class PooledDoHNameserver(dns.nameserver.DoHNameserver):
+    '''
+    DoH nameserver sending all queries through one HTTP/2 client,
+    so queries are multiplexed over a few pooled TLS connections instead of a new connection per query
+    '''
+    MAX_CONNECTIONS = 8
+
+    def __init__(self, url: str):
+        super().__init__(url)
+        self.client = None
+
+    async def async_query(self, request: dns.message.QueryMessage, timeout: float, source: Optional[str], source_port: int,
+                          max_size: bool, backend: dns.asyncbackend.Backend,
+                          one_rr_per_rrset: bool = False, ignore_trailing: bool = False) -> dns.message.Message:
+        if self.client is None:
+            # the client has to come from the module dnspython's DoH support uses, httpx2 since dnspython 2.9, httpx before
+            httpx = getattr(dns.asyncquery, 'httpx2', None) or dns.asyncquery.httpx
+            limits = httpx.Limits(max_connections=self.MAX_CONNECTIONS, max_keepalive_connections=self.MAX_CONNECTIONS)
+            self.client = httpx.AsyncClient(http1=True, http2=True, verify=self.verify, limits=limits)
+        return await dns.asyncquery.https(request, self.url, timeout=timeout, client=self.client,
+                                          one_rr_per_rrset=one_rr_per_rrset, ignore_trailing=ignore_trailing,
+                                          post=(not self.want_get))
+
+    async def aclose(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+class TokenBucket:
+    '''
+    Limit events to `rate` per second on average, allowing bursts of up to `rate` events, but at least one
+    '''
+    def __init__(self, rate: float):
+        self.rate = rate
+        # a rate below 1 still has to be able to collect a whole token
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class RateLimitedNameserver(dns.nameserver.Nameserver):
+    '''
+    Nameserver taking a token from `bucket` before each query sent to `nameserver`.
+    Sharing the bucket across nameservers limits the total query rate, cached answers don't take tokens.
+    '''
+    def __init__(self, nameserver: dns.nameserver.Nameserver, bucket: TokenBucket):
+        super().__init__()
+        self.nameserver = nameserver
+        self.bucket = bucket
+
+    def __str__(self):
+        return str(self.nameserver)
+
+    def kind(self) -> str:
+        return self.nameserver.kind()
+
+    def is_always_max_size(self) -> bool:
+        return self.nameserver.is_always_max_size()
+
+    def answer_nameserver(self) -> str:
+        return self.nameserver.answer_nameserver()
+
+    def answer_port(self) -> int:
+        return self.nameserver.answer_port()
+
+    async def async_query(self, *args, **kwargs) -> dns.message.Message:
+        await self.bucket.acquire()
+        return await self.nameserver.async_query(*args, **kwargs)
+
+    async def aclose(self) -> None:
+        if hasattr(self.nameserver, 'aclose'):
+            await self.nameserver.aclose()
+
+class SQLiteCache(dns.resolver.CacheBase):
+    '''
+    Persistent DNS answer cache stored in a SQLite database, so repeated runs don't query records again before they expire.
+    Responses are stored in wire format keyed by qname|rdtype|rdclass.
+    Answers expire after their TTL clamped to [MIN_TTL, MAX_TTL],
+    negative answers (NXDOMAIN, NoAnswer) after NEGATIVE_TTL, as most domains don't publish _mta-sts.<domain>.
+    '''
+    MIN_TTL = 60
+    MAX_TTL = 24 * 60 * 60
+    NEGATIVE_TTL = 60
+
+    def __init__(self, filename: str):
+        super().__init__()
+        # autocommit in WAL mode, so concurrent lookup processes can share the database
+        self.db = sqlite3.connect(filename, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, response BLOB NOT NULL, expiration REAL NOT NULL)')
+        # expired answers are only replaced when queried again, purge them so the database doesn't grow with every scan
+        self.db.execute('CREATE INDEX IF NOT EXISTS answers_expiration ON answers (expiration)')
+        self.db.execute('DELETE FROM answers WHERE expiration <= ?', (time.time(),))
+
+    @staticmethod
+    def dbkey(key: dns.resolver.CacheKey) -> str:
+        qname, rdtype, rdclass = key
+        return f'{qname.to_text()}|{dns.rdatatype.to_text(rdtype)}|{dns.rdataclass.to_text(rdclass)}'
+
+    def get(self, key: dns.resolver.CacheKey) -> Optional[dns.resolver.Answer]:
+        row = self.db.execute('SELECT response, expiration FROM answers WHERE key = ?', (self.dbkey(key),)).fetchone()
+        with self.lock:
+            if row is None or row[1] <= time.time():
+                self.statistics.misses += 1
+                return None
+            self.statistics.hits += 1
+        answer = dns.resolver.Answer(*key, dns.message.from_wire(row[0]))
+        answer.expiration = row[1]
+        return answer
+
+    def put(self, key: dns.resolver.CacheKey, value: dns.resolver.Answer) -> None:
+        now = time.time()
+        if value.rrset is None:
+            ttl = self.NEGATIVE_TTL
+        else:
+            ttl = min(max(value.expiration - now, self.MIN_TTL), self.MAX_TTL)
+        self.db.execute('INSERT OR REPLACE INTO answers (key, response, expiration) VALUES (?, ?, ?)',
+                        (self.dbkey(key), value.response.to_wire(), now + ttl))
+
+    def flush(self, key: Optional[dns.resolver.CacheKey] = None) -> None:
+        if key is not None:
+            self.db.execute('DELETE FROM answers WHERE key = ?', (self.dbkey(key),))
+        else:
+            self.db.execute('DELETE FROM answers')
+
+# MX records that do not represent a SMTP server:
+# - .:  Null MX as defined in RFC 7505 meaning that the domain doesn't accept any email.
+# - 0.0.0.0., localhost. and ~.: Sometimes used in indicate the same as .
+INVALID_MX = frozenset({'.', '0.0.0.0.', 'localhost.', '~.'})
+
+async def lookupmx(resolver: dns.asyncresolver.Resolver, domain: dns.name.Name) -> Tuple[List[str], bool, str, bool]:
     '''
     Return a tuple consiting of
     - list of valid MX domains, ordered by priority (and alphabetically), removing invalid MX
     - authenticated flag, True if AD flag ist present in the response
     - error details of failed resolver lookup or the removed MXs if all are invalid
+    - nxdomain flag, True if domain doesn't exist
     '''
     mxs = []
     authenticated = False
     error = ''
+    nxdomain = False
     try:
-        answer = resolver.resolve(domain, "MX")
+        answer = await resolver.resolve(domain, "MX")
         # the Answer class calls resolve_chaining to resolves up to dns.message.MAX_CHAIN (16) CNAME pointers in the response
         # AFAIU the AD flag applies to the response including all CNAME and records 
         authenticated = (answer.response.flags & dns.flags.AD) != 0
-        # sort records by name to make mxs canonical
-        records = sorted(answer, key=lambda r: r.exchange.to_unicode().lower())
-        # sort preferred MX first
-        records = sorted(records, key=lambda r: r.preference)
-        # convert bytes to str
-        mxsunfiltered = [ r.exchange.to_unicode().lower() for r in records ]
+        # convert bytes to str once per record, then sort preferred MX first and by name to make mxs canonical
+        records = sorted((r.preference, r.exchange.to_unicode().lower()) for r in answer)
+        mxsunfiltered = [ mx for _, mx in records ]
         # remove invalid MX
-        mxs = list(filter(validmx, mxsunfiltered))
+        mxs = [ mx for mx in mxsunfiltered if mx not in INVALID_MX ]
         if len(mxs) == 0:
             error = "no valid MX: " + ", ".join(mxsunfiltered)
-    except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN, dns.resolver.NoNameservers, dns.resolver.LifetimeTimeout) as e:
+    except dns.resolver.NXDOMAIN as e:
+        error = str(e)
+        # if domain is a CNAME, it's the CNAME target that doesn't exist
+        nxdomain = e.canonical_name == domain
+    except (dns.resolver.NoAnswer, dns.resolver.NoNameservers, dns.resolver.LifetimeTimeout) as e:
         error = str(e)
-    return mxs, authenticated, error
+    return mxs, authenticated, error, nxdomain
 
-@functools.cache
-def lookuptlsa(resolver: dns.resolver.Resolver, domain: str, port: int, delimiter: str) -> Tuple[int, str]:
+@cachedtask
+async def lookuptlsa(resolver: dns.asyncresolver.Resolver, domain: str, port: int, delimiter: str) -> Tuple[int, str]:
     '''
     Lookup TLSA record for domain and port
     Return
@@ -73,66 +258,88 @@ def lookuptlsa(resolver: dns.resolver.Resolver, domain: str, port: int, delimite
     '''
     error = ''
     try:
-        answer = resolver.resolve(f"_{port}._tcp.{domain}", "TLSA")
+        answer = await resolver.resolve(f"_{port}._tcp.{domain}", "TLSA")
         dane = delimiter.join([ str(r) for r in answer ])
         return 1, dane
     except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN, dns.resolver.NoNameservers, dns.resolver.LifetimeTimeout) as e:
         error = str(e)
     return 0, error
 
-def indicator(b: bool) -> int:
-    '''return bool encoded as int'''
-    if (b):
-        return 1
-    else:
-        return 0
-    
-def is_sts(txt: str) -> bool:
+def is_sts(strings: Tuple[bytes, ...]) -> bool:
     '''
-    Return True if s looks like a MSA STS TXT record without validating it
+    Return True if the strings of a TXT record look like a MSA STS TXT record without validating it
     '''
-    return txt.lower().startswith('v=stsv1')
+    # check the prefix in the first string, unless the prefix spans multiple strings
+    prefix = strings[0][:7] if len(strings[0]) >= 7 else b''.join(strings)[:7]
+    return prefix.lower() == b'v=stsv1'
+
+MTA_STS = dns.name.Name([b'_mta-sts'])
 
-def lookupsts(resolver: dns.resolver.Resolver, domain: str, delimiter: str) -> Tuple[int, str]:
+@cachedtask
+async def lookupsts(resolver: dns.asyncresolver.Resolver, domain: dns.name.Name, delimiter: str) -> Tuple[int, str]:
     '''
     Return (1, valid looking MTA STS TXT records for domain d, separated by newline)
     or (0, error details)
     '''
     txts = []
     try:
-        answer = resolver.resolve("_mta-sts." + domain, "TXT")
-        # r.strings is a tuple of bytes as per RFC1035, which we concatenate
-        txts = [ b''.join(r.strings).decode() for r in answer ]
-        # filter for v=STSv1
-        txts = [ t for t in txts if is_sts(t) ]
+        answer = await resolver.resolve(MTA_STS.concatenate(domain), "TXT")
+        # r.strings is a tuple of bytes as per RFC1035, which we filter for v=STSv1, then concatenate and decode
+        txts = [ b''.join(r.strings).decode() for r in answer if is_sts(r.strings) ]
     except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN, dns.resolver.NoNameservers, dns.resolver.LifetimeTimeout) as e:
         return 0, str(e)
-    return indicator(len(txts)), delimiter.join(txts)
+    return int(len(txts) > 0), delimiter.join(txts)
+
+async def noresult() -> Tuple[int, str]:
+    '''Result of lookups skipped, e.g. TLSA for domains without a valid MX'''
+    return 0, ''
 
-def lookupdomain(resolver: dns.resolver.Resolver, domain: str, delimiter: str, flush: bool) -> None:
+async def lookupdomain(resolver: dns.asyncresolver.Resolver, domain: str, delimiter: str) -> List[str | int]:
     '''
-    Print CSV record for domain d
+    Return CSV record for domain d
     '''
-    mxs, mxauth, mxerror = lookupmx(resolver, domain)
+    # parse the domain once for all its queries
+    name = dns.name.from_text(domain)
+    mxs, mxauth, mxerror, nxdomain = await lookupmx(resolver, name)
     if (len(mxs) > 0):
         mxdetails = delimiter.join(mxs)
         # lookup TLSA record for the preferred MX https://datatracker.ietf.org/doc/html/rfc7672#section-2.2.1
-        mxtlsaflag, mxtlsadetails = lookuptlsa(resolver, mxs[0], 25, delimiter)  
+        tlsa = lookuptlsa(resolver, mxs[0], 25, delimiter)
     else:
         mxdetails = mxerror
-        mxtlsaflag, mxtlsadetails = 0, ''
+        tlsa = noresult()
         # # If `domain` has no MX, but A/AAAA record, then SMTP trys the delivery to that IP
         # # DANE allows TLSA records for such domains https://datatracker.ietf.org/doc/html/rfc7672#section-2.2.2
         # # The code below detects the, but couldn't find an instance where this is used in practice  
         # nonmxtlsaflag, nonmxtlsadetails = lookuptlsa(resolver, domain, 25, delimiter)
         # if nonmxtlsaflag == 1:
         #     print(f"{domain}: no MX, but TLSA ({nonmxtlsadetails})", file=sys.stderr)
+    # _mta-sts.<domain> can't exist if domain doesn't https://datatracker.ietf.org/doc/html/rfc8020
+    sts = noresult() if nxdomain else lookupsts(resolver, name, delimiter)
+    # TLSA and MTA STS lookups are independent of each other, so run them concurrently
+    (mxtlsaflag, mxtlsadetails), (stsflag, stsdetails) = await asyncio.gather(tlsa, sts)
     # DANE requires DNSSEC for MX lookup *and* TLSA for MX domain https://datatracker.ietf.org/doc/html/rfc7672#section-2.2.1
-    daneflag = indicator(mxauth and mxtlsaflag)
-    stsflag, stsdetails = lookupsts(resolver, domain, delimiter)
-    print(f'{domain},{indicator(len(mxs))},{indicator(mxauth)},{mxtlsaflag},{daneflag},{stsflag},{indicator(daneflag or stsflag)},"{mxdetails}","{mxtlsadetails}","{stsdetails}"', flush=flush)
+    # flags are encoded as int 0 or 1
+    daneflag = int(mxauth and mxtlsaflag == 1)
+    return [domain, int(len(mxs) > 0), int(mxauth), mxtlsaflag, daneflag, stsflag, int(daneflag == 1 or stsflag == 1), mxdetails, mxtlsadetails, stsdetails]
 
-def parse_args(resolver: dns.resolver.Resolver) -> argparse.Namespace:
+
+async def lookupdomains(resolver: dns.asyncresolver.Resolver, domains: List[str], delimiter: str, flush: bool, concurrency: int) -> None:
+    '''
+    Lookup domains concurrently, with at most `concurrency` domains in flight, and write their CSV records as they complete
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    async def bounded(domain: str) -> List[str | int]:
+        async with semaphore:
+            return await lookupdomain(resolver, domain, delimiter)
+    # writing from this single loop keeps CSV lines intact
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    for record in asyncio.as_completed([ bounded(domain) for domain in domains ]):
+        writer.writerow(await record)
+        if flush:
+            sys.stdout.flush()
+
+def parse_args(resolver: dns.asyncresolver.Resolver) -> argparse.Namespace:
     argparser = argparse.ArgumentParser(description='Lookup SMTP DANE and MTA STS and output results in CSV format', 
                                         epilog=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
     argparser.add_argument('domains', nargs='*',
@@ -146,32 +353,75 @@ def parse_args(resolver: dns.resolver.Resolver) -> argparse.Namespace:
     argparser.add_argument('-H', '--header', action=argparse.BooleanOptionalAction,
                            help='print CSV header (default: no header)')
     argparser.add_argument('-s', '--nameserver', type=str, action='append',
-                           help='use custom nameserver, repeat to add multiple')
+                           help='use custom nameserver, IP address or DoH URL (https://...), repeat to add multiple')
+    argparser.add_argument('-p', '--parallel', type=int, default=1,
+                           help='number of nameservers queried in parallel for each lookup, 2 or 3 bound the latency of slow nameservers (default: %(default)d)')
+    argparser.add_argument('-C', '--cache', type=str,
+                           help='persist DNS answers in SQLite database CACHE and reuse them in later runs until they expire (default: no persistent cache)')
+    argparser.add_argument('-q', '--qps', type=float, default=0,
+                           help='maximum number of queries per second sent to all nameservers together (default: no limit)')
     argparser.add_argument('-d', '--delimiter', type=str, default='\\n',
                            help='delimiter string used to concatenate records (default: %(default)s)')
+    argparser.add_argument('-c', '--concurrency', type=int, default=64,
+                           help='maximum number of domains looked up concurrently (default: %(default)d)')
     argparser.add_argument('-f', '--flush', action='store_true',
                            help='flush output after each line (default: no flush)')
     opts = argparser.parse_args()
+    if opts.concurrency < 1:
+        argparser.error('argument -c/--concurrency: must be at least 1')
     opts.delimiter = bytes(opts.delimiter, 'utf-8').decode('unicode_escape') # https://docs.python.org/3/library/codecs.html#python-specific-encodings
     return opts
 
-def configure_resolver(resolver: dns.resolver.Resolver, opts: argparse.Namespace):
+def makenameserver(resolver: dns.asyncresolver.Resolver, nameserver: str | dns.nameserver.Nameserver) -> dns.nameserver.Nameserver:
+    '''
+    Return nameserver object for an IP address or a DoH URL
+    '''
+    if isinstance(nameserver, dns.nameserver.Nameserver):
+        return nameserver
+    if dns.inet.is_address(nameserver):
+        return dns.nameserver.Do53Nameserver(nameserver, resolver.nameserver_ports.get(nameserver, resolver.port))
+    return PooledDoHNameserver(nameserver)
+
+def configure_resolver(resolver: dns.asyncresolver.Resolver, opts: argparse.Namespace):
     if opts.nameserver:
         resolver.nameservers = opts.nameserver
     resolver.timeout = opts.timeout
     resolver.lifetime = opts.lifetime
     resolver.retry_servfail = opts.retry
+    # create the nameserver objects once, instead of for every query
+    resolver.nameservers = [ makenameserver(resolver, ns) for ns in resolver.nameservers ]
+    if opts.qps > 0:
+        bucket = TokenBucket(opts.qps)
+        resolver.nameservers = [ RateLimitedNameserver(ns, bucket) for ns in resolver.nameservers ]
+    if opts.cache:
+        resolver.cache = SQLiteCache(opts.cache)
+    else:
+        # many domains share their MX hosts, e.g. Google and Microsoft customers
+        resolver.cache = dns.resolver.LRUCache(max_size=100000)
     resolver.set_flags(dns.flags.RD | dns.flags.AD) # RD recursion desired, AD authenticated data
     resolver.use_edns(True) # indicate EDNS0 support to enable UDP packages > 512 byte
 
+async def main(resolver: dns.asyncresolver.Resolver, nameservers: List[dns.nameserver.Nameserver], opts: argparse.Namespace) -> None:
+    '''
+    Lookup all domains, then close nameserver connections
+    '''
+    try:
+        await lookupdomains(resolver, opts.domains, opts.delimiter, opts.flush, opts.concurrency)
+    finally:
+        for nameserver in nameservers:
+            if hasattr(nameserver, 'aclose'):
+                await nameserver.aclose()
+
 if __name__ == '__main__':
-    resolver = dns.resolver.Resolver()
+    resolver = dns.asyncresolver.Resolver()
     opts = parse_args(resolver)
     configure_resolver(resolver, opts)
+    nameservers = resolver.nameservers
+    if opts.parallel > 1 and len(resolver.nameservers) > 1:
+        resolver = RacingResolver(resolver, opts.parallel)
     try:
         if opts.header:
-            print("domain,has_mx,has_mxauth,has_mxtlsa,has_smtpdane,has_mtasts,has_any,mx_details,mxtlsa_details,mtasts_details")
-        for domain in opts.domains:
-            lookupdomain(resolver, domain, opts.delimiter, opts.flush)
+            print("domain,has_mx,has_mxauth,has_mxtlsa,has_smtpdane,has_mtasts,has_any,mx_details,mxtlsa_details,mtasts_details", flush=opts.flush)
+        asyncio.run(main(resolver, nameservers, opts))
     except KeyboardInterrupt:
         pass
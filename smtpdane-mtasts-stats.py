@@ -1,67 +1,174 @@
 #!/usr/bin/env python3
 
+import argparse
+import os
+import stat
 import sys
-import csv
-import matplotlib.pyplot as plt
+import tempfile
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.ipc as ipc
 
-if len(sys.argv) == 1:
-    print(f"usage: {sys.argv[0]} smtpdanemtasts.csv [chart.png|chart.svg [subtitle]]")
-    sys.exit(1)
-with open(sys.argv[1]) as file:
-    n = ndane = nsts = nany = nboth = nmxauth = nmxtlsa = 0
-    csvreader = csv.reader(file)
-    next(csvreader) # skip header
-    for row in csvreader:
-        # print(*row[0:5])
-        mx, mxauth, mxtlsa, dane, sts, dane_or_sts = map(int, row[1:7])
-        if not mx:
-            continue
-        ndane += dane
-        nsts += sts
-        nany += dane_or_sts
-        nmxauth += mxauth
-        nmxtlsa += mxtlsa
-        if dane == 1 and sts == 1:
-            nboth += 1
-        n += 1
-ndaneonly = ndane - nboth
-nstsonly = nsts - nboth
-nmxauthonly = nmxauth - ndane
-nmxtlsaonly = nmxtlsa - ndane
-npartialdane = nmxauthonly + ndane + nmxtlsaonly
+# only parse the flag columns, the details columns are quoted and may contain newlines
+# has_any is has_smtpdane or has_mtasts, it is derived from those
+FLAG_COLUMNS = ['has_mx', 'has_mxauth', 'has_mxtlsa', 'has_smtpdane', 'has_mtasts']
+# compressed inputs are decompressed by file extension, as pyarrow does when given a path
+COMPRESSION = {'.gz': 'gzip', '.bz2': 'bz2', '.lz4': 'lz4', '.zst': 'zstd'}
 
-print("Common mailservers")
-print("mailservers,dane_or_sts,dane_or_sts%,mx_auth,mx_auth%,mx_tlsa,mx_tlsa%,daneonly,stsonly,both,daneonly%,stsonly%,both%")
-print(f"{n},{nany},{nany/n:.1%},{nmxauth},{nmxauth/n:.1%},{nmxtlsa},{nmxtlsa/n:.1%},{ndaneonly},{nstsonly},{nboth},{ndaneonly/nany:.1%},{nstsonly/nany:.1%},{nboth/nany:.1%}")
+def opencopy(arrowpath: str, metadata: Dict[bytes, bytes]) -> Optional[ipc.RecordBatchFileReader]:
+    '''Open the Arrow copy at arrowpath if it was made from the CSV described by metadata'''
+    try:
+        reader = ipc.open_file(pa.memory_map(arrowpath))
+    except (OSError, pa.ArrowInvalid):
+        return None
+    return reader if reader.schema.metadata == metadata else None
 
-def autopct(p: float, n: int):
-    return f"{p:1.1f}% ({n*p/100:1.0f})"
-    #return f"{n*p/100:1.0f}\n{p:1.1f}%"
+def newcopy(arrowpath: str) -> Optional[IO[bytes]]:
+    '''Create a uniquely named temporary file next to arrowpath, None if the directory is not writable'''
+    try:
+        return tempfile.NamedTemporaryFile(dir=os.path.dirname(arrowpath) or '.', prefix=os.path.basename(arrowpath) + '.',
+                                           suffix='.tmp', delete=False)
+    except OSError:
+        return None
 
-if len(sys.argv) >= 3:
-    subtitle = sys.argv[3] if len(sys.argv) >= 4 else sys.argv[1] # subtitle defaults to input filename
-    tab = plt.color_sequences["tab20c"]
+def flagbatches(csvpath: str) -> Iterator[pa.RecordBatch]:
+    '''Yield the flag columns of csvpath in record batches, from the Arrow copy next to it if it was made from this CSV'''
+    arrowpath = csvpath + '.arrow'
+    # the CSV is passed as file object, a path would be seeked, which fails for pipes like <(zcat x.csv.gz)
+    with open(csvpath, 'rb') as f:
+        # only regular files are copied, the copy records the size and modification time of the CSV it was made from
+        csvstat = os.fstat(f.fileno())
+        metadata = None
+        if stat.S_ISREG(csvstat.st_mode):
+            metadata = {b'csv_size': str(csvstat.st_size).encode(), b'csv_mtime_ns': str(csvstat.st_mtime_ns).encode()}
+            copy = opencopy(arrowpath, metadata)
+            if copy is not None:
+                for i in range(copy.num_record_batches):
+                    yield copy.get_batch(i).select(FLAG_COLUMNS)
+                return
+        # stream record batches so memory use does not grow with the input size
+        # and keep a copy, reading it skips parsing the CSV next time
+        with pacsv.open_csv(pa.input_stream(f, compression=COMPRESSION.get(os.path.splitext(csvpath)[1])),
+                            parse_options=pacsv.ParseOptions(newlines_in_values=True),
+                            convert_options=pacsv.ConvertOptions(include_columns=FLAG_COLUMNS,
+                                                                 column_types={c: pa.int8() for c in FLAG_COLUMNS})) as reader:
+            tmp = newcopy(arrowpath) if metadata is not None else None
+            if tmp is None:
+                yield from reader
+                return
+            try:
+                with tmp, ipc.new_file(tmp, reader.schema.with_metadata(metadata),
+                                       options=ipc.IpcWriteOptions(compression='zstd')) as writer:
+                    for batch in reader:
+                        writer.write_batch(batch)
+                        yield batch
+                # the temporary file is private, the copy is as readable as the CSV
+                os.chmod(tmp.name, stat.S_IMODE(csvstat.st_mode))
+                # only a complete copy replaces the previous one
+                os.replace(tmp.name, arrowpath)
+            finally:
+                if os.path.exists(tmp.name):
+                    os.remove(tmp.name)
+
+def countflags(csvpath: str) -> Tuple[int, int, int, int, int, int, int]:
+    '''Count domains with MX and how many of them have each flag set, DANE and STS both last'''
+    n = nmxauth = nmxtlsa = ndane = nsts = nboth = 0
+    for batch in flagbatches(csvpath):
+        # only count domains with MX
+        batch = batch.filter(batch.column('has_mx').cast(pa.bool_()))
+        n += batch.num_rows
+        nmxauth += pc.sum(batch.column('has_mxauth'), min_count=0).as_py()
+        nmxtlsa += pc.sum(batch.column('has_mxtlsa'), min_count=0).as_py()
+        ndane += pc.sum(batch.column('has_smtpdane'), min_count=0).as_py()
+        nsts += pc.sum(batch.column('has_mtasts'), min_count=0).as_py()
+        nboth += pc.sum(pc.bit_wise_and(batch.column('has_smtpdane'), batch.column('has_mtasts')), min_count=0).as_py()
+    return n, nmxauth, nmxtlsa, ndane, nsts, ndane + nsts - nboth, nboth
+
+def labelwedges(autotexts: List, values: List[int]) -> None:
+    '''Replace the percentages pie() put in the wedges with labels precomputed from the exact counts'''
+    total = sum(values)
+    for text, value in zip(autotexts, values):
+        text.set_text(f"{value/total:.1%} ({value})")
+        #text.set_text(f"{value}\n{value/total:.1%}")
+
+def process(csvpath: str, chartpath: Optional[str] = None, subtitle: Optional[str] = None, fig = None) -> str:
+    '''Return the stats line for csvpath and draw the chart on fig and save it to chartpath if given'''
+    n, nmxauth, nmxtlsa, ndane, nsts, nany, nboth = countflags(csvpath)
+    ndaneonly = ndane - nboth
+    nstsonly = nsts - nboth
+    nmxauthonly = nmxauth - ndane
+    nmxtlsaonly = nmxtlsa - ndane
+    npartialdane = nmxauthonly + ndane + nmxtlsaonly
+
+    stats = f"{n},{nany},{nany/n:.1%},{nmxauth},{nmxauth/n:.1%},{nmxtlsa},{nmxtlsa/n:.1%},{ndaneonly},{nstsonly},{nboth},{ndaneonly/nany:.1%},{nstsonly/nany:.1%},{nboth/nany:.1%}\n"
+
+    if chartpath is None:
+        return stats
+    import matplotlib
+    if subtitle is None:
+        subtitle = csvpath # subtitle defaults to input filename
+    tab = matplotlib.color_sequences["tab20c"]
     colors = [tab[i] for i in [4, 8]]
-    fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(18, 4), layout='constrained')
+    # the figure is reused across inputs
+    fig.clear()
+    ax1, ax2, ax3 = fig.subplots(1, 3)
     fig.suptitle(subtitle, y=0.0, verticalalignment='bottom')
     #fig.subplots_adjust(wspace=.5)
     labels = ['not published', 'published']
-    ax1.pie([n - nany, nany], autopct=lambda p: autopct(p, n), labels=labels, colors=colors, explode=[0, .2], startangle=360*nany/n/2)
+    values = [n - nany, nany]
+    _, _, autotexts = ax1.pie(values, autopct='%1.1f%%', labels=labels, colors=colors, explode=[0, .2], startangle=360*nany/n/2)
+    labelwedges(autotexts, values)
     ax1.set_title(f"Email providers publishing SMTP TLS policies\n(SMTP DANE or MTA STS)\n{n}")
 
     labels = ['SMTP DANE only', 'both standards', 'MTA STS only']
     colors = [tab[i] for i in [9, 8, 10]]
-    ax2.pie([ndaneonly, nboth, nstsonly], autopct=lambda p: autopct(p, nany), colors=colors)
+    values = [ndaneonly, nboth, nstsonly]
+    _, _, autotexts = ax2.pie(values, autopct='%1.1f%%', colors=colors)
+    labelwedges(autotexts, values)
     ax2.set_title(f"SMTP TLS policy publication details\n(SMTP DANE and/or MTA STS)\n{nany}")
     ax2.legend(labels, title="Legend",
             loc="center left",
             bbox_to_anchor=(1, 0, 0.5, 1))
     
     labels = ['MX TLSA only', 'SMTP DANE', 'MX Auth only']
-    ax3.pie([nmxtlsaonly, ndane, nmxauthonly], autopct=lambda p: autopct(p, npartialdane), colors=colors)
+    values = [nmxtlsaonly, ndane, nmxauthonly]
+    _, _, autotexts = ax3.pie(values, autopct='%1.1f%%', colors=colors)
+    labelwedges(autotexts, values)
     ax3.set_title(f"Partial SMTP DANE configurations\n(Full SMTP DANE requires DNSSEC for MX lookup and TLSA records for MXs)\n{npartialdane}")
     ax3.legend(labels, title="Legend",
             loc="center left",
             bbox_to_anchor=(1, 0, 0.5, 1))
-    #plt.show()
-    plt.savefig(sys.argv[2])
\ No newline at end of file
+    fig.savefig(chartpath)
+    return stats
+
+def parse_args() -> List[List[str]]:
+    '''Parse the command line into one [csv, chart, subtitle] list per input, chart and subtitle are optional'''
+    argparser = argparse.ArgumentParser(description='Print SMTP DANE and MTA STS stats of smtpdane-mtasts-lookup.py output and optionally draw charts',
+                                        usage='%(prog)s [-h] [smtpdanemtasts.csv [chart.png|chart.svg [subtitle]]] [-i smtpdanemtasts.csv [chart.png|chart.svg [subtitle]]] ...')
+    argparser.add_argument('args', nargs='*', metavar='smtpdanemtasts.csv [chart.png|chart.svg [subtitle]]',
+                           help='input CSV, chart to draw and its subtitle (default: input CSV name)')
+    argparser.add_argument('-i', '--input', nargs='+', action='append', default=[], metavar='ARG',
+                           help='another input CSV with optional chart and subtitle, repeat to process several inputs in one run')
+    opts = argparser.parse_args()
+    groups = ([ opts.args ] if opts.args else []) + opts.input
+    if not groups:
+        argparser.error('no input CSV')
+    for group in groups:
+        if len(group) > 3:
+            argparser.error(f"unrecognized arguments after {' '.join(group[:3])}: {' '.join(group[3:])}")
+    return groups
+
+if __name__ == '__main__':
+    groups = parse_args()
+    fig = None
+    if any(len(group) >= 2 for group in groups):
+        # matplotlib is only needed for charts, importing it takes longer than computing the stats
+        from matplotlib.figure import Figure
+        # use Figure directly rather than the pyplot state machine, savefig picks the canvas for the output format
+        fig = Figure(figsize=(18, 4), layout='constrained')
+    # write the header and all stats lines at once
+    sys.stdout.write("Common mailservers\n"
+                     "mailservers,dane_or_sts,dane_or_sts%,mx_auth,mx_auth%,mx_tlsa,mx_tlsa%,daneonly,stsonly,both,daneonly%,stsonly%,both%\n"
+                     + ''.join([ process(*group, fig=fig) for group in groups ]))